@@ -4,8 +4,6 @@
 import requests # for issuing commands
 import json
 import time
-import curses
-import pprint
 from inpromptu import Inpromptu, cli_method
 from functools import wraps
 
@@ -34,12 +32,28 @@ class JubileeMotionController(Inpromptu):
 
     LOCALHOST = "127.0.0.1"
 
+    VALID_AXES = frozenset("XYZU")
+
+    # G0 templates keyed by which of (x, y, z) are specified.
+    MOVE_TEMPLATES = {(x_set, y_set, z_set): "G0 " + ("X{x} " if x_set else "")
+                                                    + ("Y{y} " if y_set else "")
+                                                    + ("Z{z} " if z_set else "") + "F13000"
+                      for x_set in (False, True)
+                      for y_set in (False, True)
+                      for z_set in (False, True)
+                      if x_set or y_set or z_set}
+
     def __init__(self, address=LOCALHOST, debug=False, simulated=False, reset=False):
         """Start with sane defaults. Setup command and subscribe connections."""
         super().__init__()
-        if address != self.__class__.LOCALHOST:
+        if address != self.LOCALHOST:
             print("Warning: disconnecting this application from the network will halt connection to Jubilee.")
         self.address = address
+        # DSF HTTP endpoints. These do not change after construction.
+        self._code_url = f"http://{address}/machine/code"
+        self._file_url = f"http://{address}/machine/file"
+        # Reuse one keep-alive connection for all requests instead of one per request.
+        self._session = requests.Session()
         self.debug = debug
         self.simulated = simulated
         self.model_update_timestamp = 0
@@ -50,10 +64,9 @@ class JubileeMotionController(Inpromptu):
         self._tool_z_offsets = None # Cached value under the @property.
         self._axis_limits = None # Cached value under the @property.
         self.axes_homed = [False]*4 # Starter value before connecting.
-        self.connect()
+        self.connect() # also enforces absolute moves.
         if reset:
             self.reset() # also does a reconnect.
-        self._set_absolute_moves(force=True)
 
 
     def connect(self):
@@ -64,8 +77,9 @@ class JubileeMotionController(Inpromptu):
         if self.debug:
             print(f"Connecting to {self.address} ...")
         try:
-            # "Ping" the machine by updating the only cacheable information we care about.
-            self.axes_homed = json.loads(self.gcode("M409 K\"move.axes[].homed\"", timeout=1))["result"][:4]
+            # "Ping" the machine by pulling all the axis info we care about in one query.
+            axes = json.loads(self.gcode("M409 K\"move.axes\"", timeout=1))["result"]
+            self.axes_homed = [axis_data["homed"] for axis_data in axes[:4]]
 
             # These data members are tied to @properties of the same name
             # without the '_' prefix.
@@ -73,13 +87,13 @@ class JubileeMotionController(Inpromptu):
             # refresh; otherwise we will retrieve old values that may be invalid.
             self._active_tool_index = None
             self._tool_z_offsets = None
-            self._axis_limits = None
+            # Axis limits came with the ping.
+            self._axis_limits = [(axis_data["min"], axis_data["max"]) for axis_data in axes]
 
             # To save time upon connecting, let's just hit the API on the
             # first try for all the @properties we care about.
             self.active_tool_index
             self.tool_z_offsets
-            self.axis_limits
             #pprint.pprint(json.loads(requests.get("http://127.0.0.1/machine/status").text))
             # TODO: recover absolute/relative from object model instead of enforcing it here.
             self._set_absolute_moves(force=True)
@@ -98,20 +112,27 @@ class JubileeMotionController(Inpromptu):
         if self.simulated:
             return None
         # RRF3 Only
-        response = requests.post(f"http://{self.address}/machine/code", data=f"{cmd}", timeout=timeout).text
+        response = self._session.post(self._code_url, data=cmd, timeout=timeout).text
         if self.debug:
             print(f"received: {response}")
             #print(json.dumps(r, sort_keys=True, indent=4, separators=(',', ':')))
         return response
 
 
+    def gcode_batch(self, cmds: list, timeout: float = None):
+        """Send several GCode cmds in one request; return the combined response.
+        Cmds are executed in order, as if they were sent one at a time.
+        """
+        # DSF accepts multiple newline-separated codes in a single request.
+        return self.gcode("\n".join(cmds), timeout=timeout)
+
+
     def download_file(self, filepath: str = None, timeout: float = None):
         """Download the file into a file object. Full filepath must be specified.
         Example: /sys/tfree0.g
         """
         # RRF3 Only
-        file_contents = requests.get(f"http://{self.address}/machine/file{filepath}",
-                                     timeout=timeout).text
+        file_contents = self._session.get(self._file_url + filepath, timeout=timeout).text
         return file_contents
 
 
@@ -123,13 +144,17 @@ class JubileeMotionController(Inpromptu):
         self.axes_homed = [False]*4
         self.disconnect()
         print("Reconnecting...")
-        for i in range(10):
-            time.sleep(1)
+        # Retry with backoff so we reconnect soon after the board is back up,
+        # but give up after roughly as long as before.
+        delay = 0.1
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            time.sleep(delay)
             try:
                 self.connect()
                 return
             except MachineStateError as e:
-                pass
+                delay = min(delay * 2, 1.0)
         raise MachineStateError("Reconnecting failed.")
 
 
@@ -138,8 +163,9 @@ class JubileeMotionController(Inpromptu):
         # Having a tool is only possible if the machine was already homed.
         if self.active_tool_index != -1:
             self.park_tool()
-        self.gcode("G28")
-        self._set_absolute_moves(force=True)
+        # Restore absolute moves in the same request since homing may change it.
+        self.gcode_batch(["G28", "G90"])
+        self.absolute_moves = True
         # Update homing state. Do not query the object model because of race condition.
         self.axes_homed = [True, True, True, True] # X, Y, Z, U
 
@@ -149,13 +175,11 @@ class JubileeMotionController(Inpromptu):
         """Home the XY axes.
         Home Y before X to prevent possibility of crashing into the tool rack.
         """
-        self.gcode("G28 Y")
-        self.gcode("G28 X")
-        self.gcode("G28 U")
-        self._set_absolute_moves(force=True)
-        # Update homing state. Pull Z from the object model which will not create a race condition.
-        z_home_status = json.loads(self.gcode("M409 K\"move.axes[].homed\""))["result"][2]
-        self.axes_homed = [True, True, z_home_status, True]
+        self.gcode_batch(["G28 Y", "G28 X", "G28 U", "G90"])
+        self.absolute_moves = True
+        # Update homing state. Homing XYU leaves Z as it was, so keep its cached value.
+        # (If it is False, @machine_is_homed re-checks the object model anyway.)
+        self.axes_homed = [True, True, self.axes_homed[2], True]
 
 
     @cli_method
@@ -165,31 +189,50 @@ class JubileeMotionController(Inpromptu):
         """
         response = input("Is the Deck free of obstacles? [y/n]")
         if response.lower() in ["y", "yes"]:
-            self.gcode("G28 Z")
-        self._set_absolute_moves(force=True)
+            self.gcode_batch(["G28 Z", "G90"])
+            self.absolute_moves = True
+            # Update homing state. Do not query the object model because of race condition.
+            self.axes_homed[2] = True
 
 
     @cli_method
     def home_in_place(self, *args: str):
         """Set the current location of a machine axis or axes to 0."""
-        for axis in args:
-            if axis.upper() not in ['X', 'Y', 'Z', 'U']:
+        axes = [axis.upper() for axis in args]
+        # Validate every axis before zeroing any of them.
+        for axis in axes:
+            if axis not in self.VALID_AXES:
                 raise TypeError(f"Error: cannot home unknown axis: {axis}.")
-            self.gcode(f"G92 {axis.upper()}0")
+        if axes:
+            # Zero all requested axes with a single command.
+            self.gcode("G92 " + " ".join(f"{axis}0" for axis in axes))
 
 
     @machine_is_homed
-    def _move_xyz(self, x: float = None, y: float = None, z: float = None, wait: bool = False):
-        """Move in XYZ. Absolute/relative set externally. Wait until done."""
+    def _move_xyz(self, x: float = None, y: float = None, z: float = None, wait: bool = False,
+                  absolute: bool = None, retract_z: float = None):
+        """Move in XYZ. Wait until done.
+        If absolute is specified, switch to absolute/relative moves in the same request.
+        Otherwise, absolute/relative is set externally.
+        If retract_z is specified, move to that Z height first, also in the same request.
+        """
         # TODO: find way to recover from out-of-bounds move requests.
 
-        x_movement = f"X{x} " if x is not None else ""
-        y_movement = f"Y{y} " if y is not None else ""
-        z_movement = f"Z{z} " if z is not None else ""
-        if x_movement or y_movement or z_movement:
-            self.gcode(f"G0 {x_movement}{y_movement}{z_movement}F13000")
+        cmds = []
+        switch_modes = absolute is not None and absolute != self.absolute_moves
+        if switch_modes:
+            cmds.append("G90" if absolute else "G91")
+        if retract_z is not None:
+            cmds.append(self.MOVE_TEMPLATES[(False, False, True)].format(z=retract_z))
+        template = self.MOVE_TEMPLATES.get((x is not None, y is not None, z is not None))
+        if template is not None:
+            cmds.append(template.format(x=x, y=y, z=z))
         if wait:
-            self.gcode(f"M400")
+            cmds.append("M400")
+        if cmds:
+            self.gcode_batch(cmds)
+        if switch_modes:
+            self.absolute_moves = absolute
 
     def _set_absolute_moves(self, force: bool = False):
         if self.absolute_moves and not force:
@@ -207,26 +250,23 @@ class JubileeMotionController(Inpromptu):
 
     def move_xyz_relative(self, x: float = None, y: float = None, z: float = None, wait: bool = False):
         """Do a relative move in XYZ."""
-        self._set_relative_moves()
-        self._move_xyz(x, y, z, wait)
+        self._move_xyz(x, y, z, wait, absolute=False)
 
 
     @cli_method
     def move_xyz_absolute(self, x: float = None, y: float = None, z: float = None, wait: bool = False):
         """Do an absolute move in XYZ."""
         # TODO: use push and pop sematics instead.
-        self._set_absolute_moves()
-        self._move_xyz(x, y, z, wait)
+        self._move_xyz(x, y, z, wait, absolute=True)
 
 
     @property
     @cli_method
     def position(self):
         """Returns the machine control point in mm."""
-        # Axes are ordered X, Y, Z, U, E, E0, E1, ... En, where E is a copy of E0.
-        response_chunks = self.gcode("M114").split()
-        positions = [float(a.split(":")[1]) for a in response_chunks[:3]]
-        return positions
+        # Axes are ordered X, Y, Z, U. Only X, Y, and Z are needed.
+        # userPosition matches M114's output, i.e: includes the active tool's offsets.
+        return json.loads(self.gcode("M409 K\"move.axes[].userPosition\""))["result"][:3]
 
 
     @cli_method
@@ -260,7 +300,7 @@ class JubileeMotionController(Inpromptu):
                 # On HTTP Interface, we get a string instead of the tool index.
                 elif response.startswith('Tool'):
                     # Recover from the string: 'Tool X is selected.'
-                    self._active_tool_index = int(response.split()[1])
+                    self._active_tool_index = int(response.split(maxsplit=2)[1])
                 else:
                     self._active_tool_index = int(response)
             except ValueError as e:
@@ -322,14 +362,24 @@ class JubileeMotionController(Inpromptu):
         [ = decrease movement step size
         ] = increase movement step size
         """
+        import curses # Only needed here. Not available on every platform.
+
         min_step_size = 0.015625
         max_step_size = 8.0
         step_size = 1
+        # Jog direction (x, y, z) for each movement key.
+        jog_directions = {curses.KEY_UP:    ( 0, -1,  0),
+                          curses.KEY_DOWN:  ( 0,  1,  0),
+                          curses.KEY_LEFT:  ( 1,  0,  0),
+                          curses.KEY_RIGHT: (-1,  0,  0),
+                          ord('w'):         ( 0,  0,  1),
+                          ord('s'):         ( 0,  0, -1)}
 
         stdscr = curses.initscr()
         curses.cbreak()
         curses.noecho()
         stdscr.keypad(True)
+        stdscr.leaveok(True) # Don't bother tracking the cursor position.
 
         stdscr.addstr(0,0, prompt)
         stdscr.addstr(2,0,"Press 'q' to quit.")
@@ -343,31 +393,35 @@ class JubileeMotionController(Inpromptu):
         key = ''
         try:
             while key != ord('q'):
+                # Block until the next key press.
+                # Note: getch() redraws the window first if it changed, so
+                # only the step size line is repainted, and only when it changes.
                 key = stdscr.getch()
-                stdscr.refresh()
-                if key == curses.KEY_UP:
-                    self.move_xyz_relative(y=-step_size)
-                elif key == curses.KEY_DOWN:
-                    self.move_xyz_relative(y=step_size)
-                elif key == curses.KEY_LEFT:
-                    self.move_xyz_relative(x=step_size)
-                elif key == curses.KEY_RIGHT:
-                    self.move_xyz_relative(x=-step_size)
-                elif key == ord('w'):
-                    self.move_xyz_relative(z=step_size)
-                elif key == ord('s'):
-                    self.move_xyz_relative(z=-step_size)
-                elif key == ord('['):
-                    step_size = step_size/2.0
-                    if step_size < min_step_size:
-                        step_size = min_step_size
-                    stdscr.addstr(7,0,f"Step Size: {step_size:<8}")
-                elif key == ord(']'):
-                    step_size = step_size*2.0
-                    if step_size > max_step_size:
-                        step_size = max_step_size
-                    stdscr.addstr(7,0,f"Step Size: {step_size:<8}")
-            self.move_xyz_relative(wait=True) # Wait for last move to finish.
+                # Drain any keys that queued up while the last move was being
+                # sent (i.e: from holding down a key) and sum them into one move.
+                dx, dy, dz = 0, 0, 0
+                stdscr.nodelay(True)
+                while key != -1 and key != ord('q'):
+                    direction = jog_directions.get(key)
+                    if direction is not None:
+                        dx += direction[0] * step_size
+                        dy += direction[1] * step_size
+                        dz += direction[2] * step_size
+                    elif key == ord('['):
+                        step_size = step_size/2.0
+                        if step_size < min_step_size:
+                            step_size = min_step_size
+                        stdscr.addstr(7,0,f"Step Size: {step_size:<8}")
+                    elif key == ord(']'):
+                        step_size = step_size*2.0
+                        if step_size > max_step_size:
+                            step_size = max_step_size
+                        stdscr.addstr(7,0,f"Step Size: {step_size:<8}")
+                    key = stdscr.getch()
+                stdscr.nodelay(False)
+                if dx or dy or dz:
+                    self.move_xyz_relative(x=dx or None, y=dy or None, z=dz or None)
+            self._move_xyz(wait=True) # Wait for last move to finish. No mode switch needed.
         finally:
             curses.nocbreak()
             stdscr.keypad(False)
@@ -378,8 +432,7 @@ class JubileeMotionController(Inpromptu):
 
     def disconnect(self):
         """Close the connection."""
-        # Nothing to do?
-        pass
+        self._session.close()
 
 
     def __enter__(self):
@@ -1,15 +1,11 @@
 #!/usr/bin/env python3
 """Driver for Controlling Jubilee as a Lab Automation Device"""
-import socket
 import json
-import time
-import copy
 import pprint
 import re
 import subprocess, signal, os # for launching/killing video feed
-from math import sqrt, acos, asin, cos, sin
+from math import hypot, atan2, cos, sin
 from functools import wraps
-from threading import Thread, Lock
 from inpromptu import cli_method, UserInputError
 from .jubilee_controller import JubileeMotionController, MachineStateError
 from .sonicator import Sonicator
@@ -56,6 +52,9 @@ class SonicationStation(JubileeMotionController):
 		          24: (4, 6),
                           12: (3, 4)} # rows, columns
     DECK_PLATE_COUNT = 6
+    # Prompt completions for setup_plate.
+    DECK_INDEX_COMPLETIONS = [str(i) for i in range(DECK_PLATE_COUNT)]
+    WELL_COUNT_COMPLETIONS = [str(c) for c in WELL_COUNT_TO_ROWS]
     DECK_PLATE_NOMINAL_CORNERS = [(287.75, 289.75),
                                   (148.25, 289.5),
                                   (287.625, 192.25),
@@ -76,20 +75,6 @@ class SonicationStation(JubileeMotionController):
     SONICATOR_TOOL_INDEX = 1
 
     # Blank Configuration Template
-    BLANK_DECK_CONFIGURATION = \
-        {"plates": {},              # plate type and location, keyed by deck index in str format.
-         "safe_z": None,            # retract height before moving around in XY.
-         "idle_z": IDLE_Z_HEIGHT,    # retraction height when the machine is idle
-         "cleaning_config": {}      # specs and protocol for cleaning.
-        }
-
-    BLANK_DECK_PLATE_CONFIG = \
-        {"id": "",
-         "corner_well_centroids": [(None, None), (None, None), (None, None)],
-         "well_count": None,
-         "liquid_level": {}
-        }
-
     BLANK_CLEANING_CONFIG = \
         {"plates": [],
          "protocol": []
@@ -109,6 +94,26 @@ class SonicationStation(JubileeMotionController):
 """
 
 
+    @classmethod
+    def _blank_deck_configuration(cls):
+        """Return a fresh blank deck configuration. (Cheaper than a deepcopy.)"""
+        return {"plates": {},               # plate type and location, keyed by deck index in str format.
+                "safe_z": None,             # retract height before moving around in XY.
+                "idle_z": cls.IDLE_Z_HEIGHT, # retraction height when the machine is idle
+                "cleaning_config": {}       # specs and protocol for cleaning.
+               }
+
+
+    @staticmethod
+    def _blank_deck_plate_config():
+        """Return a fresh blank plate configuration. (Cheaper than a deepcopy.)"""
+        return {"id": "",
+                "corner_well_centroids": [(None, None), (None, None), (None, None)],
+                "well_count": None,
+                "liquid_level": {}
+               }
+
+
     def __init__(self, address=JubileeMotionController.LOCALHOST,
                  debug=False, simulated=False, deck_config_filepath="./config.json"):
         """Start with sane defaults. Setup Deck configuration."""
@@ -116,8 +121,11 @@ class SonicationStation(JubileeMotionController):
 
         # Save the deck filepath in case we want to save to it later.
         self.deck_config_filepath = deck_config_filepath
+        # Per-plate well geometry derived from the deck config, keyed by deck index str.
+        # Computed on first use. Not part of the saved deck config.
+        self._plate_transforms = {}
         # Pull Deck Configuration if one is specified. Make a blank one otherwise.
-        self.deck_config = copy.deepcopy(self.__class__.BLANK_DECK_CONFIGURATION)
+        self.deck_config = self._blank_deck_configuration()
         if deck_config_filepath:
             try:
                 self.load_deck_config(deck_config_filepath)
@@ -135,35 +143,36 @@ class SonicationStation(JubileeMotionController):
         self.protocol_methods = self._collect_protocol_methods()
         self.sonicator = Sonicator()
         self.cam_feed_process = None
-        self.discarded_cam_output = None
 
-    def _collect_protocol_methods(self):
+    @classmethod
+    def _collect_protocol_methods(cls):
         """Collect all protocol methods decorated with the correpsonding decorator.
 
         protocol methods are any methods that can be invoked programmatically
         from a json protocol file.
+        The result depends only on the class, so it is cached on the class.
         """
+        # Look in this class's own dict so subclasses get their own cache.
+        cached = cls.__dict__.get('_protocol_methods')
+        if cached is not None:
+            return cached
         protocol_methods = {}
-        # # Workaround because getmembers does not get functions decorated specifically with @property
-        # https://stackoverflow.com/questions/3681272/can-i-get-a-reference-to-a-python-property
-        def get_dict_attr(obj, attr):
-            for obj in [obj] + obj.__class__.mro():
-                if attr in obj.__dict__:
-                    return obj.__dict__[attr]
-            raise AttributeError
-
-        for name in dir(self):
-            value = get_dict_attr(self, name)
-            # Special case properties, which store setter functions in a different location.
-            if isinstance(value, property):
-                if hasattr(value.fset, 'is_protocol_method'):
-                    protocol_methods[name] = value.fset
-                continue
-            # Special case classmethods.
-            if isinstance(value, classmethod):
-                value = value.__func__
-            if hasattr(value, 'is_protocol_method'):
-                protocol_methods[name] = value
+        # Read the class dicts directly rather than resolving every attribute
+        # on the instance. This also sees the raw @property objects.
+        # Walk base classes first so that subclass overrides take precedence.
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                # Special case properties, which store setter functions in a different location.
+                if isinstance(value, property):
+                    value = value.fset
+                # Special case classmethods.
+                elif isinstance(value, classmethod):
+                    value = value.__func__
+                if hasattr(value, 'is_protocol_method'):
+                    protocol_methods[name] = value
+                else: # An undecorated override hides the base class protocol method.
+                    protocol_methods.pop(name, None)
+        cls._protocol_methods = protocol_methods
         return protocol_methods
 
 
@@ -233,9 +242,8 @@ class SonicationStation(JubileeMotionController):
     @cli_method
     def move_xy_absolute(self, x: float = None, y: float = None, wait: bool = False):
         """Move in XY, but include the safe Z retract first if defined."""
-        if self.safe_z is not None:
-            super().move_xyz_absolute(z=self.safe_z, wait=False)
-        super().move_xyz_absolute(x,y, wait=wait)
+        # Retract and move in one request.
+        self._move_xyz(x, y, wait=wait, absolute=True, retract_z=self.safe_z)
 
     @cli_method
     def pickup_tool(self, tool_index: int):
@@ -254,7 +262,6 @@ class SonicationStation(JubileeMotionController):
         if self.active_tool_index == SonicationStation.CAMERA_TOOL_INDEX:
             self.disable_live_video()
         self.move_xy_absolute()
-        print(self.safe_z)
         super().park_tool()
 
 
@@ -274,12 +281,12 @@ class SonicationStation(JubileeMotionController):
         """Move to each teach point for the deck plate."""
         REG_POINT = ["Bottom Left", "Bottom Right", "Upper Right"]
 
-        if plate_index < 0 or plate_index >= self.__class__.DECK_PLATE_COUNT:
+        if plate_index < 0 or plate_index >= self.DECK_PLATE_COUNT:
             raise UserInputError(f"Error: deck plates must fall \
                 within the range: [0, {plate_index}).")
 
-        if self.active_tool_index != self.__class__.CAMERA_TOOL_INDEX:
-            self.pickup_tool(self.__class__.CAMERA_TOOL_INDEX)
+        if self.active_tool_index != self.CAMERA_TOOL_INDEX:
+            self.pickup_tool(self.CAMERA_TOOL_INDEX)
 
         if self.position[2] < self.safe_z:
             self.move_xyz_absolute(z=self.safe_z)
@@ -312,7 +319,8 @@ class SonicationStation(JubileeMotionController):
             print(f"Reloading deck configuration. Overriding any unsaved configuration changes.")
         with open(file_path, 'r') as config_file:
             print(f"Loading deck configuration from {file_path}.")
-            self.deck_config = json.loads(config_file.read())
+            self.deck_config = json.load(config_file)
+            self._plate_transforms.clear()
             # Update the load location so we default to saving the file we loaded from.
             file_path = self.deck_config_filepath
         self.check_config()
@@ -442,7 +450,7 @@ class SonicationStation(JubileeMotionController):
         try:
             # Ask for deck index if the user didn't input it.
             if deck_index is None:
-                self.completions = list(map(str,range(self.__class__.DECK_PLATE_COUNT)))
+                self.completions = self.DECK_INDEX_COMPLETIONS
                 deck_index = int(self.input(f"Enter deck index: "))
 
             # Json dicts enforce that keys must be strings.
@@ -456,16 +464,18 @@ class SonicationStation(JubileeMotionController):
                                       "Continuing will override the current config. Continue? [y/n]: ")
                 if response.lower() not in ["y", "yes"]:
                     return
-                # Save a local copy so we can restore it if the user aborts.
-                old_plate_config = copy.deepcopy(self.deck_config['plates'][deck_index_str])
+                # Keep the old config so we can restore it if the user aborts.
+                # No copy needed; it gets replaced below, not modified.
+                old_plate_config = self.deck_config['plates'][deck_index_str]
 
             # Create a new deck configuration from scratch.
-            self.deck_config['plates'][deck_index_str] = copy.deepcopy(self.__class__.BLANK_DECK_PLATE_CONFIG)
+            self.deck_config['plates'][deck_index_str] = self._blank_deck_plate_config()
+            self._plate_transforms.pop(deck_index_str, None)
 
             # Ask for well count (plate type) if the user didn't input it.
             # TODO: ask for the plate type with an enum instead of by well count.
             if well_count is None:
-                self.completions = list(map(str, self.__class__.WELL_COUNT_TO_ROWS.keys()))
+                self.completions = self.WELL_COUNT_COMPLETIONS
                 well_count = int(self.input(f"Enter number of wells: "))
             self.deck_config['plates'][deck_index_str]['well_count'] = well_count
 
@@ -483,17 +493,17 @@ class SonicationStation(JubileeMotionController):
                 self.input(f"Please load the plate in deck slot {deck_index}. "
                            "Press Enter when finished.")
 
-            row_count, col_count = self.__class__.WELL_COUNT_TO_ROWS[well_count]
+            row_count, col_count = self.WELL_COUNT_TO_ROWS[well_count]
             last_row_letter = chr(row_count + 65 - 1)
 
             # PART 1: Define the plate location with teach points.
             self.enable_live_video()
             # Move such that the well plates are in focus.
-            self.move_xyz_absolute(z=(self.safe_z + self.__class__.CAMERA_FOCAL_LENGTH_OFFSET))
-            self.pickup_tool(self.__class__.CAMERA_TOOL_INDEX)
+            self.move_xyz_absolute(z=(self.safe_z + self.CAMERA_FOCAL_LENGTH_OFFSET))
+            self.pickup_tool(self.CAMERA_TOOL_INDEX)
             # Rapid to the corner of this deck index.
-            self.move_xyz_absolute(x=self.__class__.DECK_PLATE_NOMINAL_CORNERS[deck_index][0],
-                                   y=self.__class__.DECK_PLATE_NOMINAL_CORNERS[deck_index][1])
+            self.move_xyz_absolute(x=self.DECK_PLATE_NOMINAL_CORNERS[deck_index][0],
+                                   y=self.DECK_PLATE_NOMINAL_CORNERS[deck_index][1])
 
             # Collect three "teach points" for this plate.
             self.input("Commencing manual zeroing. Press Enter when ready or 'CTRL-C' to abort")
@@ -515,7 +525,7 @@ class SonicationStation(JubileeMotionController):
 
             # PART 2: Define the plate height with the sonicator.
             self.move_xy_absolute() # Safe Z
-            self.pickup_tool(self.__class__.SONICATOR_TOOL_INDEX)
+            self.pickup_tool(self.SONICATOR_TOOL_INDEX)
             x,y = self._get_well_position(deck_index, 0, 0) # Relies on teach points being set already.
             self.move_xy_absolute(x,y)
             self.input("In the next step, we will set the reference point from where the "
@@ -531,6 +541,7 @@ class SonicationStation(JubileeMotionController):
             # Restore previous copy.
             if old_plate_config:
                 self.deck_config['plates'][deck_index_str] = old_plate_config
+                self._plate_transforms.pop(deck_index_str, None)
         finally:
             self.disable_live_video()
         self.park_tool()
@@ -568,8 +579,8 @@ class SonicationStation(JubileeMotionController):
         if plunge_height < 0:
             raise UserInputError("Error: plunge depth is too deep.")
 
-        if self.active_tool_index != self.__class__.SONICATOR_TOOL_INDEX:
-            self.pickup_tool(self.__class__.SONICATOR_TOOL_INDEX)
+        if self.active_tool_index != self.SONICATOR_TOOL_INDEX:
+            self.pickup_tool(self.SONICATOR_TOOL_INDEX)
 
         row_index = ord(row_letter.upper()) - 65 # convert letters to numbers.
         column_index -=1 # Convert 1-indexed plates to 0-indexing.
@@ -598,19 +609,19 @@ class SonicationStation(JubileeMotionController):
     def execute_protocol_from_file(self, protocol_file_path):
         """Open the protocol file and run the protocol."""
         with open(protocol_file_path, 'r') as protocol_file:
-            protocol = json.loads(protocol_file.read())
-            self.execute_protocol(protocol)
+            protocol = json.load(protocol_file)
+        self.execute_protocol(protocol)
 
 
     def execute_protocol(self, protocol):
         """Execute a list of protocol commands."""
+        protocol_methods = self.protocol_methods
         for cmd in protocol:
-            if cmd['operation'] not in self.protocol_methods:
-                raise UserInputError(f"Error. Method cmd['name'] is not a method that can be used in a protocol.")
-            fn = self.protocol_methods[cmd['operation']]
-            kwargs = cmd['specs']
-            kwargs['self'] = self
-            fn(**kwargs)
+            fn = protocol_methods.get(cmd['operation'])
+            if fn is None:
+                raise UserInputError(f"Error. Method {cmd['operation']} is not a method that can be used in a protocol.")
+            # Pass self explicitly so that the protocol specs are never modified.
+            fn(self, **cmd['specs'])
 
 
     def enable_live_video(self):
@@ -620,10 +631,10 @@ class SonicationStation(JubileeMotionController):
             return
         print("Starting camera feed.")
         script_name = os.path.join(os.path.dirname(__file__), 'launch_camera_alignment_feed.sh')
-        self.discarded_cam_output = open(os.devnull, 'w')
+        # Own session/process group (like os.setsid) so we can kill everything the script launches.
         self.cam_feed_process = \
-            subprocess.Popen(script_name, shell=True,
-                             preexec_fn=os.setsid, stderr=self.discarded_cam_output)
+            subprocess.Popen(["sh", script_name], start_new_session=True,
+                             stderr=subprocess.DEVNULL)
 
 
     def disable_live_video(self):
@@ -633,46 +644,60 @@ class SonicationStation(JubileeMotionController):
             os.killpg(os.getpgid(self.cam_feed_process.pid), signal.SIGTERM)
             #self.cam_feed_process.kill() This doesn't work.
             self.cam_feed_process = None
-        if self.discarded_cam_output is not None:
-            self.discarded_cam_output.close()
 
 
-    def _get_well_position(self, deck_index: int, row_index: int, col_index: int):
-        """Get the machine coordinates for the specified well plate index."""
-
-        # Json dicts enforce that keys must be strings.
-        deck_index_str = str(deck_index)
+    def _get_plate_transform(self, deck_index_str: str):
+        """Get the well geometry for the specified plate, computing it if not cached.
+        Returns (row_count, col_count, origin, x_spacing, y_spacing, cos_theta, sin_theta).
+        """
+        transform = self._plate_transforms.get(deck_index_str)
+        if transform is not None:
+            return transform
 
         # Note: Lookup well spacing from a built-in dict for now.
         well_count = self.deck_config['plates'][deck_index_str]["well_count"]
-        row_count, col_count = self.__class__.WELL_COUNT_TO_ROWS[well_count]
-
-        if row_index > (row_count - 1) or col_index > (col_count - 1):
-            raise LookupError(f"Requested well index ({row_index}, {col_index}) "
-                              f"is out of bounds for a plate with {row_count} rows "
-                              f"and {col_count} columns.")
+        row_count, col_count = self.WELL_COUNT_TO_ROWS[well_count]
 
         a = self.deck_config['plates'][deck_index_str]["corner_well_centroids"][0]
         b = self.deck_config['plates'][deck_index_str]["corner_well_centroids"][1]
         c = self.deck_config['plates'][deck_index_str]["corner_well_centroids"][2]
 
-        plate_width = sqrt((b[0] - a[0])**2 + (b[1] - a[1])**2)
-        plate_height = sqrt((c[0] - b[0])**2 + (c[1] - b[1])**2)
+        plate_width = hypot(b[0] - a[0], b[1] - a[1])
+        plate_height = hypot(c[0] - b[0], c[1] - b[1])
 
         # Note: we assume evenly spaced wells but possibly distinct x and y spacing
         x_spacing = plate_width/(col_count - 1)
         y_spacing = plate_height/(row_count - 1)
 
         # We have two redundant angle measurements. Average them.
-        theta1 = acos((c[1] - b[1])/plate_height)
-        theta2 = acos((b[0] - a[0])/plate_width)
-        theta = (theta1 + theta2)/2.0
+        # a->b is the plate's x axis rotated by theta; b->c is its y axis rotated by theta.
+        theta1 = atan2(-(c[0] - b[0]), c[1] - b[1])
+        theta2 = atan2(b[1] - a[1], b[0] - a[0])
+        # Average as unit vectors so angles on either side of +/-pi don't cancel out.
+        theta = atan2(sin(theta1) + sin(theta2), cos(theta1) + cos(theta2))
+
+        transform = (row_count, col_count, a, x_spacing, y_spacing, cos(theta), sin(theta))
+        self._plate_transforms[deck_index_str] = transform
+        return transform
+
+
+    def _get_well_position(self, deck_index: int, row_index: int, col_index: int):
+        """Get the machine coordinates for the specified well plate index."""
+
+        # Json dicts enforce that keys must be strings.
+        row_count, col_count, a, x_spacing, y_spacing, cos_theta, sin_theta = \
+            self._get_plate_transform(str(deck_index))
+
+        if row_index > (row_count - 1) or col_index > (col_count - 1):
+            raise LookupError(f"Requested well index ({row_index}, {col_index}) "
+                              f"is out of bounds for a plate with {row_count} rows "
+                              f"and {col_count} columns.")
 
         # Start with the nominal spot; then translate and rotate to final spot.
         x_nominal = col_index * x_spacing
         y_nominal = row_index * y_spacing
-        x_transformed = x_nominal * cos(theta) - y_nominal * sin(theta) + a[0]
-        y_transformed = x_nominal * sin(theta) + y_nominal * cos(theta) + a[1]
+        x_transformed = x_nominal * cos_theta - y_nominal * sin_theta + a[0]
+        y_transformed = x_nominal * sin_theta + y_nominal * cos_theta + a[1]
 
         return x_transformed, y_transformed
 
@@ -689,7 +714,7 @@ class SonicationStation(JubileeMotionController):
         super().__exit__(args)
 
     def cmdloop(self):
-        print(self.__class__.SPLASH)
+        print(self.SPLASH)
         super().cmdloop()
 
 